@@ -27,10 +27,11 @@
 # Monitor the red line of the in-game route advisor and steer with the mouse
 # controls to keep the truck on road.
 
+import sys
 import time
+import threading
 import numpy as np
 from mss import mss
-from pynput import mouse
 
 # Region of interest (roi) of the screen
 #
@@ -39,6 +40,8 @@ from pynput import mouse
 # this should also be the center of your region of interest.
 # A higher 'width' will give a greater field-of-view, but will be less
 # performant.
+# A 'height' of more than one row makes the detection more robust against
+# noise, a column counts as colored when any of its rows is colored.
 # The defaults were determined when the game was in fullscreen.
 roi_top = 850
 roi_left = 1625
@@ -77,6 +80,11 @@ Kd = float(1 / 5)
 # higher number means shorter iteration sleep time.
 iteration_speed = 75
 
+# Capture timeout:
+# Amount of iterations without a successful screen grab after which the route
+# is declared out of sight and steering stops.
+capture_timeout = 5
+
 # Color range
 #
 # Color values used to determine whether a pixel is colored or not.  You can
@@ -95,10 +103,14 @@ print_max_length = 64
 # Character to print at the end of a printed line
 print_end_char = '\r'
 
+# Amount of iterations between printing the controller status
+print_interval = 5
+
 # Print text that overwrites the last printed line
 def print_line(string):
-    rest = print_max_length - len(string)
-    print(string[:print_max_length], ' ' * rest, end=print_end_char)
+    sys.stdout.write(string.ljust(print_max_length)[:print_max_length] +
+                     print_end_char)
+    sys.stdout.flush()
 
 # Clamp a value between a given limit
 def clamp(value, limit):
@@ -109,120 +121,292 @@ def clamp(value, limit):
     else:
         return value
 
-# Function that decides if a pixel is colored
-def is_pixel_colored(red, green, blue):
-    return red >= red_min and red <= red_max and \
-           green >= green_min and green <= green_max and \
-           blue >= blue_min and blue <= blue_max
-
-# Grab an instance of mss (for taking screenshots)
-sct = mss()
-
-# Grab an instance of the mouse controls
-mouse = mouse.Controller()
+# Move the mouse horizontally by the given amount of pixels
+if sys.platform == 'win32':
+    # On Windows, move the cursor straight through GetCursorPos and
+    # SetCursorPos with a single preallocated point, just like pynput does but
+    # without its layers in between
+    import ctypes
+    from ctypes import wintypes
+
+    get_cursor_pos = ctypes.windll.user32.GetCursorPos
+    set_cursor_pos = ctypes.windll.user32.SetCursorPos
+    cursor = wintypes.POINT()
+    cursor_ref = ctypes.byref(cursor)
+
+    def move_mouse(dx):
+        get_cursor_pos(cursor_ref)
+        set_cursor_pos(int(cursor.x + dx), cursor.y) # change in y is 0
+else:
+    from pynput import mouse
+
+    # Grab an instance of the mouse controls
+    mouse_controller = mouse.Controller()
+
+    def move_mouse(dx):
+        mouse_controller.move(dx, 0) # change in y is 0
+
+# Create a lookup table for each color channel that tells whether a channel
+# value (0 to 255) lies within the color range
+red_ok = np.zeros(256, dtype=bool)
+red_ok[red_min:red_max + 1] = True
+green_ok = np.zeros(256, dtype=bool)
+green_ok[green_min:green_max + 1] = True
+blue_ok = np.zeros(256, dtype=bool)
+blue_ok[blue_min:blue_max + 1] = True
+
+# Channels (index in BGRA) to check after the red channel, together with their
+# lookup table.  A channel whose color range covers all values can never
+# reject a pixel, so it is left out.
+channel_checks = [(channel, table)
+                  for channel, table in ((1, green_ok), (0, blue_ok))
+                  if not table.all()]
+
+# Find the columns of an image that contain a colored pixel
+def colored_columns(image):
+    # Decide for all pixels at once whether they are colored, by looking up
+    # each BGR channel in its color range table.  The red channel is checked
+    # first, as it already rejects most pixels that are not part of the route.
+    mask = red_ok[image[..., 2]]
+
+    # Only check the other channels when there are red pixels at all
+    if mask.any():
+        for channel, table in channel_checks:
+            mask &= table[image[..., channel]]
+
+    # A column is colored when any of its rows is colored
+    return np.flatnonzero(mask.any(axis=0))
 
 # Create region of interest dictionary
 roi = {"top": roi_top, "left": roi_left, "width": roi_width, "height": roi_height}
 
-# Initialize error variables
-error = None
-old_error = None
-
-# Interval (sleep) time to use
-interval_time = (1 / iteration_speed)
-
-# Variables for the PID controller
-proportional = integral = derivative = 0
-
-# Run for as long as we're allowed to live
-while(True):
-    # Grab the region of interest of the screen
-    screen = sct.grab(roi)
-    img = np.array(screen)
-
-    # The image should be only one row in height
-    row = img[0]
-
-    # Get the length (amount of pixels horizontally)
-    length = len(img[0])
-
-    # Set the initial pixel information
-    first_pixel = length # First colored pixel
-    last_pixel = 0 # Last colored pixel
-    found_first = False # If the first colored pixel is found
-    found_last = False # If the last colored pixel is found
-
-    # Iterate over each pixel in the row
-    for x in range(length):
-        # Current pixel
-        pixel = row[x];
-
-        # Get each RGB value of this pixel
-        red = pixel[2]
-        green = pixel[1]
-        blue = pixel[0]
-
-        # Only save this position if it is the very first colored pixel
-        if x < first_pixel and is_pixel_colored(red, green, blue):
-            first_pixel = x
-            found_first = True
-
-        # Only save this position if it is the very last colored pixel
-        if x > last_pixel and is_pixel_colored(red, green, blue):
-            last_pixel = x
-            found_last = True
-
-    # Only respond when colored pixels were found
-    if not found_first or not found_last:
-        print_line("Route out of sight")
-        proportional = integral = derivative = 0
-    else:
-        # Calculate the width of the colored area
-        width = last_pixel - first_pixel
-
-        # Calculate the center of the colored area
-        center_position = first_pixel + float(width) / 2
-
-        if width < error_max:
-            # Calculate the error value
-            error = center_position - center_static
+# Newest image and the time its grab started, shared between the capture thread
+# and the main loop
+latest_image = None
+latest_time = 0
+
+# Time at which the last successful grab started, also when the screen had not
+# changed
+grab_time = 0
+latest_lock = threading.Lock()
+latest_event = threading.Event()
+
+# Keep grabbing the region of interest and publish the newest image
+def capture():
+    global latest_image, latest_time, grab_time
+
+    # Grab an instance of mss (for taking screenshots), this has to be done in
+    # the thread that uses it
+    sct = mss()
+
+    # Keep everything used in the loop in local variables, which are faster to
+    # look up than globals and attributes
+    grab = sct.grab
+    region = roi
+    perf_counter = time.perf_counter
+    sleep = time.sleep
+    frombuffer = np.frombuffer
+    uint8 = np.uint8
+    lock = latest_lock
+    event = latest_event
+
+    # Raw bytes of the previously published screen
+    previous_raw = None
+
+    # Do not grab faster than the main loop iterates, keep a deadline for the
+    # next grab just like the main loop does
+    interval_time = (1 / iteration_speed)
+    next_time = perf_counter()
+
+    while(True):
+        # Time at which the grab starts, which is when the screen is read
+        now = perf_counter()
+        screen = grab(region)
+        grab_time = now
+
+        # Only publish a screen that has changed since the last one
+        raw = screen.raw
+        if raw != previous_raw:
+            previous_raw = raw
+
+            # View the raw BGRA bytes as rows of pixels without copying them
+            image = frombuffer(raw, dtype=uint8).reshape(screen.height,
+                                                         screen.width, 4)
+
+            with lock:
+                latest_image = image
+                latest_time = now
+                event.set()
+
+        # Sleep until the next deadline
+        next_time += interval_time
+        delay = next_time - perf_counter()
+        if delay > 0:
+            sleep(delay)
         else:
-            # Do not use the error value
-            print_line("Route detection unreliable")
-            error = None
-
-        # Do not respond on first iteration (change in error is not known yet)
-        if error != None and old_error != None:
-            # Calculate the difference in error compared to the previous iteration
-            change = error - old_error
-
-            # Proportional control
-            proportional = error
-
-            # Integral control
-            integral = integral + error * interval_time
-            integral = clamp(integral, roi_width / 2)
-
-            # Derivative control
-            derivative = change / interval_time
-
-            # Calculate the output
-            output = Kp * proportional + Ki * integral + Kd * derivative
-            output = clamp(output, roi_width / 2)
-
-            # Now move the mouse
-            mouse.move(output, 0) # change in y is 0
-
-            # Print status
-            txt = "P {:.2f}".format(proportional) + "  " \
-                  "I {:.2f}".format(integral) + "  " \
-                  "D {:.2f}".format(derivative) + "  " \
-                  "Offset {:.2f}".format(error) + "  " \
-                  "Change {:.2f}".format(change)
-            print_line(txt)
-
-        # Record the current error for the next iteration
-        old_error = error
-
-    # Give our actions a little time to take effect
-    time.sleep(interval_time)
+            # Grab took too long, start counting from now
+            next_time = perf_counter()
+
+# Steer the truck, all state of the controller is kept in local variables of
+# this function, which are faster to look up than globals
+def main():
+    # Initialize error variables, together with the time at which the image
+    # of the old error was grabbed
+    error = None
+    old_error = None
+    old_image_time = 0
+
+    # Interval (sleep) time to use
+    interval_time = (1 / iteration_speed)
+
+    # Deadline of the next iteration and the time the previous one started
+    next_time = last_time = time.perf_counter()
+
+    # Pixel information of the last scanned image
+    first_pixel = last_pixel = 0 # First and last colored pixel
+    found_first = found_last = False # If the first and last pixel are found
+
+    # Variables for the PID controller: proportional, integral and derivative
+    pid = np.zeros(3, dtype=np.float32)
+    gains = np.array([Kp, Ki, Kd], dtype=np.float32)
+
+    # Amount of iterations since the controller status was last printed
+    print_count = 0
+
+    # Limit of the integral and the output of the controller, and the maximum
+    # age of the last grab
+    output_limit = roi_width / 2
+    stall_time = capture_timeout * interval_time
+
+    # Grab the screen in the background, so that the main loop does not have to
+    # wait for the grab itself
+    capture_thread = threading.Thread(target=capture, daemon=True)
+    capture_thread.start()
+
+    # Keep everything used in the loop in local variables as well, the
+    # functions of this script under a shorter name
+    lock = latest_lock
+    wait = latest_event.wait
+    clear = latest_event.clear
+    capture_alive = capture_thread.is_alive
+    perf_counter = time.perf_counter
+    dot = np.dot
+    scan = colored_columns
+    limit = clamp
+    move = move_mouse
+    show = print_line
+
+    # Run for as long as we're allowed to live
+    while(True):
+        # Wait for the capture thread to publish a new image, until the
+        # deadline of this iteration.  A new image is processed as soon as it
+        # arrives, without one the result of the previous scan is used again.
+        image = None
+        if wait(max(0, next_time - perf_counter())):
+            with lock:
+                image = latest_image
+                image_time = latest_time
+                clear()
+
+        # Measure the actual time passed since the previous iteration
+        now = perf_counter()
+        delta_time = now - last_time
+        last_time = now
+
+        # Stop when the capture thread has died, its error is already shown
+        if not capture_alive():
+            sys.exit("Screen capture stopped")
+
+        # Do not steer on a result that is older than the capture timeout
+        stalled = now - grab_time > stall_time
+
+        # Only scan a new image, while the screen does not change the result
+        # of the previous scan is used again and the controller keeps steering
+        if image is not None:
+            # Get the length (amount of pixels horizontally)
+            length = image.shape[1]
+
+            # Reset the pixel information
+            first_pixel = length # First colored pixel
+            last_pixel = 0 # Last colored pixel
+            found_first = False # If the first colored pixel is found
+            found_last = False # If the last colored pixel is found
+
+            # Find the columns that contain colored pixels
+            colored = scan(image)
+
+            # Save the positions of the very first and very last colored pixel
+            if colored.size:
+                first_pixel = int(colored[0])
+                last_pixel = int(colored[-1])
+                found_first = found_last = True
+
+                # On HiDPI screens the image can be larger than the region of
+                # interest, map the positions back onto its columns
+                if length != roi_width:
+                    scale = roi_width / length
+                    first_pixel = (first_pixel + 0.5) * scale - 0.5
+                    last_pixel = (last_pixel + 0.5) * scale - 0.5
+
+        # Only respond when colored pixels were found
+        if stalled or not found_first or not found_last:
+            show("Route out of sight")
+            pid[:] = 0
+        else:
+            # Calculate the width of the colored area
+            width = last_pixel - first_pixel
+
+            if width < error_max:
+                # Calculate the error value from the center of the colored area
+                error = (first_pixel + last_pixel) * 0.5 - center_static
+            else:
+                # Do not use the error value
+                show("Route detection unreliable")
+                error = None
+
+            # Do not respond on first iteration (change in error is not known
+            # yet)
+            if error != None and old_error != None:
+                # Proportional control
+                pid[0] = error
+
+                # Integral control
+                pid[1] = limit(pid[1] + error * delta_time, output_limit)
+
+                # Derivative control, only a new image tells how much the
+                # error changed since the previous image, so hold the
+                # derivative otherwise
+                if image is not None:
+                    change = error - old_error
+                    pid[2] = change / (image_time - old_image_time)
+                else:
+                    change = 0
+
+                # Calculate the output
+                output = float(dot(gains, pid))
+                output = limit(output, output_limit)
+
+                # Now move the mouse
+                move(output)
+
+                # Print status, but not on every iteration
+                print_count += 1
+                if print_count >= print_interval:
+                    print_count = 0
+                    show("P %6.2f  I %6.2f  D %6.2f  "
+                         "Offset %6.2f  Change %6.2f"
+                         % (pid[0], pid[1], pid[2], error, change))
+
+            # Record the current error for the next image
+            if image is not None:
+                old_error = error
+                old_image_time = image_time
+
+        # Set the deadline of the next iteration
+        next_time += interval_time
+        if next_time < perf_counter():
+            # Iteration took too long, start counting from now
+            next_time = perf_counter()
+
+if __name__ == "__main__":
+    main()